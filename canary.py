@@ -2,15 +2,18 @@
 #!nix-shell -i python3 -p python3Packages.requests gitAndTools.gh
 
 import argparse
+import hashlib
 import json
 import os
 import random
 import re
-import select
+import selectors
 import subprocess
 import sys
+import tempfile
 import time
-from typing import List, NamedTuple, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Tuple
 
 import requests
 
@@ -35,11 +38,67 @@ args = parser.parse_args()
 attr = args.attr
 cc = args.cc
 
+# Shared session so that GitHub API calls reuse connections.
+session = requests.Session()
+session.headers.update(
+    {"Accept": "application/vnd.github.v3+json", "User-Agent": "nixpkgs-upkeep"}
+)
+# Authenticated requests get a much higher search rate limit. The workflows pass
+# the token as GH_TOKEN for the gh CLI. Unauthenticated is fine in development.
+github_token = os.environ.get("GH_TOKEN") or os.environ.get("GITHUB_TOKEN")
+if github_token:
+    session.headers["Authorization"] = f"Bearer {github_token}"
+
+# Cache of GitHub search responses keyed by query, used for conditional requests.
+# In practice this only hits within a single run (ie the re-check before creating
+# an issue): the tags in the query come from `hash()`, which is randomized per
+# process, and $RUNNER_TEMP is wiped at the end of each job.
+SEARCH_CACHE_DIR = os.path.join(
+    os.environ.get("RUNNER_TEMP", tempfile.gettempdir()), "canary-cache"
+)
+
+# Matched against raw stderr bytes so that we only decode the lines we need.
+_FIRST_ERR_RE = re.compile(
+    rb"error: builder for '/nix/store/(\w{32})-(.*).drv' failed with exit code \d+;"
+)
+
+# Python package pnames look like "python3.12-foo", for any python3 minor version.
+_PY_PREFIX_RE = re.compile(r"python3\.(\d+)-(.*)")
+
+# Log noise that would otherwise screw up our hash calculation of the last 10
+# log lines. Every alternative is replaced by "", so they are fused into a single
+# pattern and scrubbed in one pass. The leftmost match wins, so eg a store path
+# is removed whole even if its hash contains something that looks like timing
+# info. Order of alternatives only matters for matches starting at the same
+# position, where timing info must come before the semver pattern.
+_SCRUB_RE = re.compile(
+    "|".join(
+        [
+            # Pytest will output things like
+            #     ==== 17 failed, 2164 passed, 53 skipped, 598 warnings in 604.22s (0:10:04) =====
+            r"(?P<sec>\d+.\d+s)",
+            r"(?P<hms>\d+:\d+:\d+)",
+            # buildPhase has started outputting like
+            #     buildPhase completed in 2 minutes 22 seconds
+            # See https://github.com/NixOS/nixpkgs/issues/212864.
+            r"(?P<min>\d+ minutes)",
+            r"(?P<secs>\d+ seconds)",
+            # Nix store paths change quite frequently, so best to ignore those. See https://discourse.nixos.org/t/someones-bot-is-creating-multiple-repeated-issues-for-failing-packages/21054.
+            r"(?P<store>/nix/store/\w{32})",
+            # Skip Bazel intermediate, non-deterministic log output. See https://github.com/NixOS/nixpkgs/issues/255049.
+            r"(?P<bazel>> \[[,\d+]* / [,\d+]*\] .*)",
+            r"(?P<info>> INFO:.*)",
+            # Semantic versions (x.y.z). See https://github.com/NixOS/nixpkgs/issues/352755.
+            r"(?P<ver>\d+\.\d+\.\d+)",
+        ]
+    )
+)
+
 
 class ProcessResult(NamedTuple):
     returncode: int
-    stdout: List[str]
-    stderr: List[str]
+    stdout: List[bytes]
+    stderr: List[bytes]
 
 
 def run(cmd_args) -> ProcessResult:
@@ -50,29 +109,43 @@ def run(cmd_args) -> ProcessResult:
     )
     stdout = []
     stderr = []
-    while True:
-        r, _, _ = select.select([p.stdout.fileno(), p.stderr.fileno()], [], [])
-        # For some reason the fd's will sometimes say that they're ready to read
-        # but then will read an empty byte string.
-        no_read = True
-        for fd in r:
-            if fd == p.stdout.fileno():
-                read = p.stdout.readline()
-                if read != b"":
-                    no_read = False
-                    sys.stdout.buffer.write(b"stdout: " + read)
-                    sys.stdout.flush()
-                    stdout.append(read)
-            elif fd == p.stderr.fileno():
-                read = p.stderr.readline()
-                if read != b"":
-                    no_read = False
-                    sys.stderr.buffer.write(b"stderr: " + read)
-                    sys.stderr.flush()
-                    stderr.append(read)
-
-        if no_read and p.poll() is not None:
-            return ProcessResult(p.poll(), stdout, stderr)
+    # Read in large chunks from non-blocking pipes and split lines ourselves,
+    # rather than paying for a select + readline round trip per line.
+    sel = selectors.DefaultSelector()
+    for pipe, prefix, out, captured in [
+        (p.stdout, b"stdout: ", sys.stdout, stdout),
+        (p.stderr, b"stderr: ", sys.stderr, stderr),
+    ]:
+        os.set_blocking(pipe.fileno(), False)
+        sel.register(pipe.fileno(), selectors.EVENT_READ, (prefix, out, captured))
+    bufs = {p.stdout.fileno(): bytearray(), p.stderr.fileno(): bytearray()}
+
+    while sel.get_map():
+        for key, _ in sel.select():
+            prefix, out, captured = key.data
+            buf = bufs[key.fd]
+            try:
+                chunk = os.read(key.fd, 1 << 16)
+            except BlockingIOError:
+                continue
+            if chunk == b"":
+                # EOF. Flush any trailing output that lacks a final newline.
+                sel.unregister(key.fd)
+                lines = [bytes(buf)] if buf else []
+            else:
+                buf += chunk
+                lines = []
+                while (nl := buf.find(b"\n")) != -1:
+                    lines.append(bytes(buf[: nl + 1]))
+                    del buf[: nl + 1]
+            if not lines:
+                continue
+            out.buffer.write(b"".join(prefix + line for line in lines))
+            out.flush()
+            captured.extend(lines)
+
+    sel.close()
+    return ProcessResult(p.wait(), stdout, stderr)
 
 
 # Use --fallback to prevent errors like https://github.com/samuela/nixpkgs-upkeep/actions/runs/5581874789/jobs/10200511969
@@ -82,29 +155,35 @@ if build_result.returncode == 0:
     print("Build succeeded")
     sys.exit(0)
 
-# Find the error lines in the stderr...
-stderr_utf8 = [line.decode("utf-8") for line in build_result.stderr]
+# Scan the raw stderr bytes once for known spurious failures before decoding.
+stderr_blob = b"".join(build_result.stderr)
 
 # See https://github.com/NixOS/nixpkgs/issues/235313.
-if "no space left on device" in "".join(stderr_utf8).lower():
+if b"no space left on device" in stderr_blob.lower():
     print("Failed due to 'No space left on device', exiting")
     sys.exit(0)
 
 # See https://github.com/NixOS/nixpkgs/issues/235426.
-if "Killed" in "".join(stderr_utf8):
+if b"Killed" in stderr_blob:
     print("Failed due to 'Killed', exiting")
     sys.exit(0)
 
-first_error_line_re = (
-    r"error: builder for '/nix/store/(\w{32})-(.*).drv' failed with exit code \d+;"
-)
-first_error_line_ = [
-    (ix, re.match(first_error_line_re, line))
-    for ix, line in enumerate(stderr_utf8)
-    if re.match(first_error_line_re, line) is not None
-]
-
-if len(first_error_line_) != 1:
+# Don't keep a second copy of stderr around for the rest of the script.
+del stderr_blob
+
+# Find the error line in the stderr. We need exactly one, so stop scanning as
+# soon as we see a second.
+first_error_line_ = None
+for ix, line in enumerate(build_result.stderr):
+    m = _FIRST_ERR_RE.match(line)
+    if m is None:
+        continue
+    if first_error_line_ is not None:
+        first_error_line_ = None
+        break
+    first_error_line_ = (ix, m)
+
+if first_error_line_ is None:
     # This can happen when eg there's an error like
     #
     #     error: tensorflow-gpu-2.13.0 not supported for interpreter python3.12
@@ -113,38 +192,21 @@ if len(first_error_line_) != 1:
     print("Failed to find error line, exiting")
     sys.exit(build_result.returncode)
 
-first_error_line_ix, match = first_error_line_[0]
-failing_drv_hash = match.group(1)
-failing_pname_version = match.group(2)
+first_error_line_ix, match = first_error_line_
+failing_drv_hash = match.group(1).decode("utf-8")
+failing_pname_version = match.group(2).decode("utf-8")
 
 # Note that after `first_error_line_ix` there's the "last 10 log lines:" and
 # then, starts 10 lines of logs.
-last_10_log_lines = stderr_utf8[first_error_line_ix + 2 : first_error_line_ix + 12]
-
-# Pytest will output things like
-#     ==== 17 failed, 2164 passed, 53 skipped, 598 warnings in 604.22s (0:10:04) =====
-# And the timing info will screw up our hash calculation, so we have to strip it
-# out.
-last_10_log_lines_pure = re.sub(r"\d+.\d+s", "", "".join(last_10_log_lines))
-last_10_log_lines_pure = re.sub(r"\d+:\d+:\d+", "", last_10_log_lines_pure)
-
-# buildPhase has started outputting like
-#     buildPhase completed in 2 minutes 22 seconds
-# so we need to get rid of that stuff as well. See https://github.com/NixOS/nixpkgs/issues/212864.
-last_10_log_lines_pure = re.sub(r"\d+ minutes", "", last_10_log_lines_pure)
-last_10_log_lines_pure = re.sub(r"\d+ seconds", "", last_10_log_lines_pure)
-
-# Nix store paths change quite frequently, so best to ignore those. See https://discourse.nixos.org/t/someones-bot-is-creating-multiple-repeated-issues-for-failing-packages/21054.
-last_10_log_lines_pure = re.sub(r"/nix/store/\w{32}", "", last_10_log_lines_pure)
-
-# Skip Bazel intermediate, non-deterministic log output. See https://github.com/NixOS/nixpkgs/issues/255049.
-last_10_log_lines_pure = re.sub(
-    r"> \[[,\d+]* / [,\d+]*\] .*", "", last_10_log_lines_pure
-)
-last_10_log_lines_pure = re.sub(r"> INFO:.*", "", last_10_log_lines_pure)
+last_10_log_lines = b"".join(
+    build_result.stderr[first_error_line_ix + 2 : first_error_line_ix + 12]
+).decode("utf-8")
 
-# Remove semantic versions (x.y.z) from log lines. See https://github.com/NixOS/nixpkgs/issues/352755.
-last_10_log_lines_pure = re.sub(r"\d+\.\d+\.\d+", "", last_10_log_lines_pure)
+# Only the logs from the error line onwards end up in the issue body.
+error_log = b"".join(build_result.stderr[first_error_line_ix:]).decode("utf-8").strip()
+
+# Strip timing info, store paths, versions, etc. so the hash is stable.
+last_10_log_lines_pure = _SCRUB_RE.sub("", last_10_log_lines)
 
 # Note that we don't include the nixpkgs commit, since that changes very
 # frequently and would likely create duplicate issues.
@@ -152,16 +214,59 @@ logs_tag = hash(f"nixpkgs-upkeep {failing_pname_version} {last_10_log_lines_pure
 drv_tag = hash(f"nixpkgs-upkeep {failing_drv_hash}")
 
 
-def find_existing_issues(tag):
-    existing_issues = requests.get(
-        "https://api.github.com/search/issues",
-        headers={"Accept": "application/vnd.github.v3+json"},
-        params={"q": f"{tag} org:NixOS repo:nixpkgs is:issue author:samuela"},
-    ).json()
+def search_issues(q: str):
+    """Query the GitHub issue search API, using a conditional request if we have
+    a cached response for this query. 304 responses don't count against the
+    search rate limit."""
+    cache_path = os.path.join(
+        SEARCH_CACHE_DIR, hashlib.sha256(q.encode("utf-8")).hexdigest() + ".json"
+    )
+    cached = None
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        # Missing or corrupt cache entries are just a cache miss.
+        pass
+
+    headers = {}
+    if cached is not None:
+        headers["If-None-Match"] = cached["etag"]
+    r = session.get(
+        "https://api.github.com/search/issues", headers=headers, params={"q": q}
+    )
+    if r.status_code == 304 and cached is not None:
+        return cached["body"]
+    # Rate limiting and server errors raise here so that they get retried.
+    r.raise_for_status()
+
+    body = r.json()
+    if r.status_code == 200 and "ETag" in r.headers:
+        # Write to a temp file and rename it into place so that concurrent
+        # canary jobs never see a partially written entry.
+        os.makedirs(SEARCH_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=SEARCH_CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"etag": r.headers["ETag"], "body": body}, f)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return body
+
+
+def find_existing_issues(*tags):
+    # Search for all of the tags in a single query to save on round trips and
+    # search rate limit.
+    query = " OR ".join(str(tag) for tag in tags)
+    existing_issues = search_issues(
+        f"({query}) org:NixOS repo:nixpkgs is:issue author:samuela"
+    )
     existing_issues_count = existing_issues["total_count"]
     if existing_issues_count > 0:
         print(
-            f"{existing_issues_count} existing issue(s) found for tag {logs_tag}: {existing_issues}"
+            f"{existing_issues_count} existing issue(s) found for tags {query}: {existing_issues}"
         )
 
         # Fail with the exit code from the build
@@ -171,22 +276,48 @@ def find_existing_issues(tag):
         sys.exit(0)
 
 
-# At this point, we need to check if there's an existing issue and create one if
-# not. Best to sleep some random amount of time to mitigate race conditions with
-# other canary jobs. Note `time.sleep` takes seconds.
-#
-# Expected difference in times between two processes will be 1/3*max_time.
-# Setting max_time to 15 minutes should more than suffice.
-#
-# For context, see https://discourse.nixos.org/t/someones-bot-is-creating-multiple-repeated-issues-for-failing-packages/21054.
-print("Patience is a virtue, especially when dealing with concurrent processes...")
-time.sleep(random.randint(0, 15 * 60))
-
-# Check if an issue already exists for this tag.
-print("Looking for existing issues with the same logs tag...")
-find_existing_issues(logs_tag)
-print("Looking for existing issues with the same drv tag...")
-find_existing_issues(drv_tag)
+def is_retryable(e: requests.RequestException) -> bool:
+    """Network errors, rate limiting and server errors are worth retrying. Other
+    HTTP errors (eg 422 for a bad query) won't go away by themselves."""
+    if e.response is None:
+        return True
+    status = e.response.status_code
+    return status in (403, 429) or status >= 500
+
+
+def retry_after(e: requests.RequestException) -> float:
+    """How long GitHub asked us to wait before retrying, or 0 if it didn't say."""
+    if e.response is None:
+        return 0
+    headers = e.response.headers
+    if "Retry-After" in headers:
+        return float(headers["Retry-After"])
+    if headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in headers:
+        return max(0, float(headers["X-RateLimit-Reset"]) - time.time())
+    return 0
+
+
+def with_backoff(f, *fargs, attempts=7, base=2, cap=60):
+    """Call `f`, retrying on request errors with full-jitter exponential backoff.
+    With the defaults the total wait can exceed a minute, enough to outlast the
+    per-minute search rate limit even if GitHub doesn't say when it resets."""
+    for attempt in range(attempts):
+        try:
+            return f(*fargs)
+        except requests.RequestException as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            # Still jitter on top of any requested wait so that parallel canary
+            # jobs don't all come back at the same moment.
+            delay = retry_after(e) + random.uniform(0, min(cap, base * 2**attempt))
+            print(f"Request failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+# Check if an issue already exists for either tag. Most of the time one does, so
+# we can bail out right away without waiting around.
+print("Looking for existing issues with the same logs or drv tag...")
+with_backoff(find_existing_issues, logs_tag, drv_tag)
 
 
 # Parse out the pname and version, then parse out attr from pname.
@@ -199,14 +330,9 @@ failing_pname, failing_version = split_pname_version(failing_pname_version)
 
 
 def pname_to_attr(pname: str) -> str:
-    if pname.startswith("python3.9-"):
-        return f"python39Packages.{pname[10:]}"
-    elif pname.startswith("python3.10-"):
-        return f"python310Packages.{pname[11:]}"
-    elif pname.startswith("python3.11-"):
-        return f"python311Packages.{pname[11:]}"
-    elif pname.startswith("python3.12-"):
-        return f"python312Packages.{pname[11:]}"
+    m = _PY_PREFIX_RE.match(pname)
+    if m is not None:
+        return f"python3{m.group(1)}Packages.{m.group(2)}"
     # jaxlib has an "internal" package for the bazel build. Annoying to hardcode
     # but better UX this way.
     elif pname == "bazel-build-jaxlib":
@@ -217,45 +343,103 @@ def pname_to_attr(pname: str) -> str:
 
 failing_attr = pname_to_attr(failing_pname)
 
-commit = (
-    subprocess.run(
-        ["git", "log", "-1", "--pretty=format:%H"],
-        cwd=args.nixpkgs,
-        stdout=subprocess.PIPE,
+
+def get_commit() -> str:
+    return (
+        subprocess.run(
+            ["git", "log", "-1", "--pretty=format:%H"],
+            cwd=args.nixpkgs,
+            stdout=subprocess.PIPE,
+        )
+        .stdout.decode("utf-8")
+        .strip()
     )
-    .stdout.decode("utf-8")
-    .strip()
-)
 
 
-def get_maintainers(attr: str) -> List[str]:
+# Looks up meta.maintainers for a JSON list of (possibly dotted) attrs, importing
+# nixpkgs once. Missing attrs and attrs that `throw` get no maintainers.
+MAINTAINERS_EXPR = """
+{ nixpkgs, attrs }:
+let
+  pkgs = import (/. + nixpkgs) { };
+  get = a:
+    let
+      v = pkgs.lib.attrByPath (pkgs.lib.splitString "." a ++ [ "meta" "maintainers" ]) [ ] pkgs;
+      r = builtins.tryEval (builtins.deepSeq v v);
+    in if r.success then r.value else [ ];
+in builtins.listToAttrs (map (a: { name = a; value = get a; }) (builtins.fromJSON attrs))
+"""
+
+
+def eval_maintainers(attrs: List[str]) -> Dict[str, List[str]]:
     p = subprocess.run(
-        ["nix", "eval", "--json", "--file", args.nixpkgs, f"{attr}.meta.maintainers"],
+        [
+            "nix",
+            "eval",
+            "--json",
+            "--impure",
+            "--expr",
+            MAINTAINERS_EXPR,
+            "--argstr",
+            "nixpkgs",
+            os.path.abspath(args.nixpkgs),
+            "--argstr",
+            "attrs",
+            json.dumps(attrs),
+        ],
         stdout=subprocess.PIPE,
     )
-    if p.returncode == 0:
-        maintainers_json = json.loads(p.stdout.decode("utf-8").strip())
-        return [m["github"] for m in maintainers_json]
-    else:
-        print(f"Failed to get maintainers for {attr}")
-        return []
+    p.check_returncode()
+    maintainers_json = json.loads(p.stdout.decode("utf-8").strip())
+    return {a: [m["github"] for m in maintainers_json[a]] for a in attrs}
+
+
+def get_maintainers(attrs: List[str]) -> Dict[str, List[str]]:
+    """Look up the maintainers of several attrs with a single nixpkgs evaluation.
+    If that fails, fall back to looking up each attr on its own so that one bad
+    attr doesn't cost the others their maintainers."""
+    try:
+        return eval_maintainers(attrs)
+    except (subprocess.CalledProcessError, KeyError, ValueError):
+        pass
+
+    maintainers = {}
+    for a in attrs:
+        try:
+            maintainers[a] = eval_maintainers([a])[a]
+        except (subprocess.CalledProcessError, KeyError, ValueError):
+            print(f"Failed to get maintainers for {a}")
+            maintainers[a] = []
+    return maintainers
+
+
+def get_nix_info() -> str:
+    return (
+        subprocess.run(
+            ["nix-shell", "-p", "nix-info", "--run", "nix-info -m"],
+            stdout=subprocess.PIPE,
+        )
+        .stdout.decode("utf-8")
+        .strip()
+    )
 
 
-attr_maintainers = get_maintainers(attr)
-failing_attr_maintainers = get_maintainers(failing_attr)
+# These are independent and mostly spent waiting on subprocesses, so run them
+# concurrently.
+with ThreadPoolExecutor() as executor:
+    commit_future = executor.submit(get_commit)
+    maintainers_future = executor.submit(get_maintainers, [attr, failing_attr])
+    nix_info_future = executor.submit(get_nix_info)
+commit = commit_future.result()
+maintainers = maintainers_future.result()
+nix_info = nix_info_future.result()
+attr_maintainers = maintainers[attr]
+failing_attr_maintainers = maintainers[failing_attr]
 
 nixpkgs_config = (
     open(os.path.expanduser("~/.config/nixpkgs/config.nix"), "r").read().strip()
 )
 
-nix_info = (
-    subprocess.run(
-        ["nix-shell", "-p", "nix-info", "--run", "nix-info -m"], stdout=subprocess.PIPE
-    )
-    .stdout.decode("utf-8")
-    .strip()
-)
-
 # We provide defaults to the env var lookup just so that it's easier in
 # development.
 github_workflow_url = f"https://github.com/{os.environ.get('GITHUB_REPOSITORY', '<GITHUB_REPOSITORY>')}/actions/runs/{os.environ.get('GITHUB_RUN_ID', '<GITHUB_RUN_ID>')}"
@@ -264,7 +448,7 @@ issue_body = f"""
 Build of `{failing_attr}` failed on x86_64-linux as of {commit}. This is currently breaking `{attr}`.
 
 ```
-{"".join(stderr_utf8[first_error_line_ix:]).strip()}
+{error_log}
 ```
 
 [full build log]({github_workflow_url})
@@ -293,6 +477,19 @@ This issue was automatically generated by [nixpkgs-upkeep](https://github.com/sa
 - Internal tags: {logs_tag} {drv_tag}
 """
 
+# At this point, we need to create an issue. Best to sleep some random amount of
+# time to mitigate race conditions with other canary jobs, and then check again
+# before creating it. Note `time.sleep` takes seconds.
+#
+# Expected difference in times between two processes will be 1/3*max_time.
+# Setting max_time to 15 minutes should more than suffice.
+#
+# For context, see https://discourse.nixos.org/t/someones-bot-is-creating-multiple-repeated-issues-for-failing-packages/21054.
+print("Patience is a virtue, especially when dealing with concurrent processes...")
+time.sleep(random.uniform(0, 15 * 60))
+print("Looking again for existing issues with the same logs or drv tag...")
+with_backoff(find_existing_issues, logs_tag, drv_tag)
+
 # Create issue
 subprocess.run(
     [